@@ -1,20 +1,32 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash
+import uuid
+import click
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context
+from sqlalchemy.exc import IntegrityError
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from models import db, Teacher, Slot, Substitution, User
-from utils import parse_timetable
-from datetime import datetime, timedelta
+from utils import parse_timetable, school_today, day_matches_date, day_for_date, date_range, PERIODS
+from migrations import run_migrations
+from engine_profiles import normalize_url, engine_options, use_replica
+from counters import bump_counters, counters_for, quota_usage, QUOTA_SPAN
+from events import record_event, latest_event_id, event_stream
+from archive import archive_school, archived_between
+from datetime import datetime
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-key-secret')
 
 # Database configuration: Use Railway's DATABASE_URL if available, else local SQLite
-database_url = os.environ.get('DATABASE_URL', 'sqlite:///timetable.db')
-if database_url and database_url.startswith("postgres://"):
-    database_url = database_url.replace("postgres://", "postgresql://", 1)
+database_url = normalize_url(os.environ.get('DATABASE_URL', 'sqlite:///timetable.db'))
 app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(database_url)
+
+# Optional read-only replica for the history views (/log, /reports)
+replica_url = normalize_url(os.environ.get('DATABASE_REPLICA_URL'))
+if replica_url:
+    app.config['SQLALCHEMY_BINDS'] = {'replica': {'url': replica_url, **engine_options(replica_url)}}
 
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = 'uploads'
@@ -32,8 +44,17 @@ db.init_app(app)
 # Ensure upload directory exists
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-with app.app_context():
+def init_db():
+    # Schema setup runs once per deploy (flask init-db), never at import, so
+    # concurrent workers cannot race on create_all or the migrations.
     db.create_all()
+    run_migrations()
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create missing tables and apply pending migrations."""
+    init_db()
+    click.echo('Database is up to date')
 
 @app.route('/')
 def index():
@@ -132,8 +153,10 @@ def find_substitute():
         teacher_id = request.form.get('teacher_id')
         day = request.form.get('day')
         period = request.form.get('period')
+        lesson_date_str = request.form.get('lesson_date')
+        rank = request.form.get('rank', 'load')
 
-        if not all([teacher_id, day, period]):
+        if not all([teacher_id, period, lesson_date_str]):
             flash('Please select all fields', 'warning')
             return redirect(url_for('find_substitute'))
         
@@ -143,6 +166,25 @@ def find_substitute():
         if original_teacher.user_id != current_user.id:
             flash('Unauthorized', 'danger')
             return redirect(url_for('find_substitute'))
+
+        selected = {'teacher_id': int(teacher_id), 'day': day, 'period': period,
+                    'lesson_date': lesson_date_str, 'rank': rank}
+        try:
+            lesson_date = datetime.strptime(lesson_date_str, '%Y-%m-%d').date()
+        except ValueError:
+            flash('Invalid date', 'warning')
+            return redirect(url_for('find_substitute'))
+
+        # The date decides the day; the day list is only needed for timetables
+        # whose day names are not in DAYS_MAP.
+        if not day:
+            day = selected['day'] = day_for_date(days, lesson_date)
+            if not day:
+                flash(f'لا توجد حصص في جدول المدرسة بتاريخ {lesson_date_str}', 'warning')
+                return render_template('find.html', teachers=teachers, days=days, periods=periods, selected=selected)
+        elif not day_matches_date(day, lesson_date):
+            flash(f'التاريخ {lesson_date_str} لا يوافق يوم {day}', 'warning')
+            return render_template('find.html', teachers=teachers, days=days, periods=periods, selected=selected)
         
         # Verify original teacher has a lesson
         original_slot = Slot.query.filter_by(
@@ -158,9 +200,7 @@ def find_substitute():
             # Let's stop if no lesson, or maybe just warn. 
             # "App checks... If not, show warning." implies we shouldn't proceed or at least warn.
             # I will return to form with warning.
-            return render_template('find.html', teachers=teachers, days=days, periods=periods, selected={
-                'teacher_id': int(teacher_id), 'day': day, 'period': period
-            })
+            return render_template('find.html', teachers=teachers, days=days, periods=periods, selected=selected)
 
         # Find available teachers
         # Logic: Teachers who have a slot at this time AND has_lesson is False
@@ -172,6 +212,16 @@ def find_substitute():
             Slot.period_number == period,
             Slot.has_lesson == False
         ).all()
+        # Teachers already covering another class at this date and period
+        busy = {row[0] for row in db.session.query(Substitution.covering_teacher_id).filter(
+            Substitution.user_id == current_user.id,
+            Substitution.lesson_date == lesson_date,
+            Substitution.period_number == period
+        )}
+        available_slots = [slot for slot in available_slots if slot.teacher_id not in busy]
+
+        # Windowed substitution counts for all candidates in one lookup
+        counts = counters_for([slot.teacher_id for slot in available_slots], lesson_date)
         
         candidates = []
         for slot in available_slots:
@@ -197,22 +247,30 @@ def find_substitute():
                 has_lesson=True
             ).count()
             
-            # Count substitutions taken by this teacher
-            subs_taken = Substitution.query.filter_by(covering_teacher_id=teacher.id).count()
+            # Substitutions taken by this teacher in the week/month/term of the lesson
+            teacher_counts = counts[teacher.id]
             
             candidates.append({
                 'teacher': teacher,
                 'daily_load': daily_load,
                 'weekly_load': total_weekly_lessons,
-                'subs_taken': subs_taken,
-                'quota': teacher.substitution_quota
+                'subs_week': teacher_counts['week'],
+                'subs_month': teacher_counts['month'],
+                'subs_taken': teacher_counts['term'],
+                'quota': teacher.substitution_quota,
+                'quota_usage': quota_usage(teacher_counts, teacher.substitution_quota),
+                # One key per assign form, so each button is its own idempotent request
+                'idempotency_key': uuid.uuid4().hex
             })
             
         # 3. Sort by weekly load first, then daily load
         # User requested "business" (load) calculation based on all the week.
-        # Maybe we should sort by 'subs_taken' first? Or keep existing logic?
-        # User didn't ask to change sort, just add counter.
-        candidates.sort(key=lambda x: (x['weekly_load'], x['daily_load']))
+        if rank == 'fairness':
+            # Teachers who reached their quota go last, then fewest recent substitutions
+            candidates.sort(key=lambda x: (x['quota_usage'] >= 1, x['subs_week'], x['subs_month'],
+                                           x['subs_taken'], x['weekly_load'], x['daily_load']))
+        else:
+            candidates.sort(key=lambda x: (x['weekly_load'], x['daily_load']))
         
         # Extract teacher objects for compatibility, but maybe we want to pass the whole dict to show stats?
         # The current template expects a list of teachers.
@@ -222,9 +280,19 @@ def find_substitute():
                                original_teacher=original_teacher,
                                day=day,
                                period=period,
+                               lesson_date=lesson_date,
+                               last_event_id=latest_event_id(current_user.id),
                                candidates=candidates) # Changed from available_teachers to candidates
 
-    return render_template('find.html', teachers=teachers, days=days, periods=periods)
+    return render_template('find.html', teachers=teachers, days=days, periods=periods,
+                           selected={'lesson_date': school_today(current_user).isoformat()})
+
+def _assign_response(message, category, status):
+    # JSON clients get a status code; the HTML form gets a flash and a redirect
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'status': category, 'message': message}), status
+    flash(message, category)
+    return redirect(url_for('log') if status < 400 else url_for('find_substitute'))
 
 @app.route('/assign', methods=['POST'])
 @login_required
@@ -235,70 +303,100 @@ def assign_substitute():
     ot = Teacher.query.get(original_teacher_id)
     ct = Teacher.query.get(covering_teacher_id)
     if not ot or ot.user_id != current_user.id or not ct or ct.user_id != current_user.id:
-        flash('Unauthorized', 'danger')
-        return redirect(url_for('find_substitute'))
+        return _assign_response('Unauthorized', 'danger', 403)
 
     day = request.form.get('day')
-    period = request.form.get('period')
+    try:
+        period = int(request.form.get('period', ''))
+        lesson_date = datetime.strptime(request.form.get('lesson_date', ''), '%Y-%m-%d').date()
+    except ValueError:
+        return _assign_response('Invalid period or lesson date', 'danger', 400)
+    if not day or period not in PERIODS:
+        return _assign_response('Invalid day or period', 'danger', 400)
+    # The unique indexes key on lesson_date while /log and /reports show day_of_week
+    if not day_matches_date(day, lesson_date):
+        return _assign_response(f'التاريخ {lesson_date} لا يوافق يوم {day}', 'danger', 400)
+    idempotency_key = (request.headers.get('Idempotency-Key') or request.form.get('idempotency_key') or None)
+    # Longer keys would not fit the column (a DataError on Postgres, not an IntegrityError)
+    if idempotency_key and len(idempotency_key) > Substitution.idempotency_key.type.length:
+        return _assign_response('Idempotency key is too long', 'danger', 400)
     
     sub = Substitution(
+        user_id=current_user.id,
         original_teacher_id=original_teacher_id,
         covering_teacher_id=covering_teacher_id,
         day_of_week=day,
-        period_number=period
+        period_number=period,
+        lesson_date=lesson_date,
+        idempotency_key=idempotency_key
     )
-    db.session.add(sub)
-    db.session.commit()
+    # No pre-check or lock: the unique indexes decide, and a violation is
+    # resolved after the fact.
+    try:
+        db.session.add(sub)
+        db.session.flush()
+        bump_counters(sub.covering_teacher_id, lesson_date, 1)
+        record_event(sub, 'assigned')
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        existing = idempotency_key and Substitution.query.filter_by(
+            user_id=current_user.id, idempotency_key=idempotency_key).first()
+        if existing:
+            # Replay of a request that already went through, as long as it is the same request
+            if (existing.original_teacher_id, existing.covering_teacher_id, existing.lesson_date,
+                    existing.period_number) == (ot.id, ct.id, lesson_date, period):
+                return _assign_response('Substitution assigned successfully!', 'success', 200)
+            return _assign_response('Idempotency key was already used for a different assignment',
+                                    'danger', 422)
+        if Substitution.query.filter_by(
+                covering_teacher_id=covering_teacher_id, lesson_date=lesson_date, period_number=period).first():
+            return _assign_response(f'{ct.name} مكلف بحصة أخرى في هذا الوقت', 'warning', 409)
+        return _assign_response(f'تمت تغطية حصة {ot.name} في هذا الوقت مسبقاً', 'warning', 409)
     
-    flash('Substitution assigned successfully!', 'success')
-    return redirect(url_for('log'))
+    return _assign_response('Substitution assigned successfully!', 'success', 201)
 
 @app.route('/log')
 @login_required
+@use_replica
 def log():
-    substitutions = Substitution.query.join(Teacher, Substitution.original_teacher_id == Teacher.id)\
-        .filter(Teacher.user_id == current_user.id)\
-        .order_by(Substitution.created_at.desc()).all()
-    return render_template('log.html', substitutions=substitutions)
+    substitutions = Substitution.query.filter_by(user_id=current_user.id)\
+        .order_by(Substitution.lesson_date.desc(), Substitution.period_number.desc()).all()
+    return render_template('log.html', substitutions=substitutions,
+                           last_event_id=latest_event_id(current_user.id))
+
+@app.route('/events')
+@login_required
+def events():
+    # Browsers send Last-Event-ID when reconnecting; the page passes last_id on first connect
+    last_id = request.headers.get('Last-Event-ID') or request.args.get('last_id')
+    try:
+        last_id = int(last_id)
+    except (TypeError, ValueError):
+        last_id = latest_event_id(current_user.id)
+    return Response(stream_with_context(event_stream(current_user.id, last_id)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/reports', methods=['GET'])
 @login_required
+@use_replica
 def reports():
     filter_type = request.args.get('type', 'day') # day or month
     date_str = request.args.get('date')
     
-    query = Substitution.query.join(Teacher, Substitution.original_teacher_id == Teacher.id)\
-        .filter(Teacher.user_id == current_user.id)
-    
-    if date_str:
-        if filter_type == 'day':
-            # date_str is YYYY-MM-DD
-            try:
-                date_obj = datetime.strptime(date_str, '%Y-%m-%d')
-                # Filter by exact date
-                # SQLite doesn't have easy date extraction functions in all versions, 
-                # but we can filter by range or cast.
-                # Since created_at is datetime, we check date part.
-                # To be DB agnostic-ish:
-                next_day = date_obj + timedelta(days=1)
-                query = query.filter(Substitution.created_at >= date_obj, Substitution.created_at < next_day)
-            except ValueError:
-                pass
-        elif filter_type == 'month':
-            # date_str is YYYY-MM
-            try:
-                year, month = map(int, date_str.split('-'))
-                query = query.filter(db.extract('year', Substitution.created_at) == year,
-                                     db.extract('month', Substitution.created_at) == month)
-            except ValueError:
-                pass
-    else:
-        # Default to today if no date provided for day view
-        if filter_type == 'day':
-            today = datetime.now().date()
-            query = query.filter(Substitution.created_at >= datetime.combine(today, datetime.min.time()))
-
-    substitutions = query.order_by(Substitution.created_at.desc()).all()
+    # lesson_date is already a local calendar date, so both filters are a
+    # half-open range on the (user_id, lesson_date) index.
+    start, end = date_range(filter_type, date_str, school_today(current_user))
+    substitutions = Substitution.query.filter(
+        Substitution.user_id == current_user.id,
+        Substitution.lesson_date >= start,
+        Substitution.lesson_date < end
+    ).order_by(Substitution.lesson_date, Substitution.period_number).all()
+    # Archived periods can end anywhere (archive-substitutions --before), so always
+    # include them; it is the same indexed range scan on a second table.
+    substitutions += archived_between(current_user.id, start, end)
+    substitutions.sort(key=lambda sub: (sub.lesson_date, sub.period_number))
     
     return render_template('reports.html', substitutions=substitutions, filter_type=filter_type, date_str=date_str)
 
@@ -309,6 +407,8 @@ def delete_log(id):
     if sub.original_teacher.user_id != current_user.id:
         flash('Unauthorized', 'danger')
         return redirect(url_for('log'))
+    bump_counters(sub.covering_teacher_id, sub.lesson_date, -1)
+    record_event(sub, 'deleted')
     db.session.delete(sub)
     db.session.commit()
     flash('تم حذف المناوبة بنجاح', 'success')
@@ -322,7 +422,8 @@ def delete_log(id):
 @login_required
 def manage_teachers():
     teachers = Teacher.query.filter_by(user_id=current_user.id).order_by(Teacher.name).all()
-    return render_template('manage_teachers.html', teachers=teachers)
+    counts = counters_for([t.id for t in teachers], school_today(current_user))
+    return render_template('manage_teachers.html', teachers=teachers, counts=counts, quota_span=QUOTA_SPAN)
 
 @app.route('/teachers/add', methods=['POST'])
 @login_required
@@ -364,5 +465,20 @@ def toggle_exclude_teacher(id):
         
     return redirect(url_for('manage_teachers'))
 
+@app.cli.command('archive-substitutions')
+@click.option('--before', help='Archive lessons before this date (YYYY-MM-DD). Defaults to each school\'s current term start.')
+@click.option('--user-id', type=int, help='Only archive this school.')
+def archive_substitutions_command(before, user_id):
+    """Move substitutions from closed terms into the archive table."""
+    before = datetime.strptime(before, '%Y-%m-%d').date() if before else None
+    users = [db.session.get(User, user_id)] if user_id else User.query.all()
+    for user in users:
+        if user is None:
+            raise click.BadParameter(f'No school with id {user_id}', param_hint='--user-id')
+        moved = archive_school(user, before)
+        click.echo(f'{user.username}: archived {moved} substitutions')
+
 if __name__ == '__main__':
+    with app.app_context():
+        init_db()
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,66 @@
+from sqlalchemy.orm import aliased
+from models import db, Teacher, Substitution, ArchivedSubstitution
+from counters import window_starts, prune_counters
+from utils import school_today
+
+# Moves substitutions from closed terms into archived_substitution, so /log, /find
+# and the counters only ever work on the current term. Reports read both tables.
+
+BATCH_SIZE = 1000
+
+def archive_cutoff(user):
+    """
+    First day of the school's current term; everything before it is closed.
+    """
+    return window_starts(school_today(user))['term']
+
+def archive_school(user, before=None):
+    """
+    Moves the school's substitutions with lesson_date < before (default: the start
+    of the current term) into the archive, in batches. Returns the number moved.
+    """
+    before = before or archive_cutoff(user)
+    original, covering = aliased(Teacher), aliased(Teacher)
+    moved = 0
+    while True:
+        rows = db.session.query(
+            Substitution, original.name, covering.name, covering.subject
+        ).outerjoin(original, Substitution.original_teacher_id == original.id)\
+         .outerjoin(covering, Substitution.covering_teacher_id == covering.id)\
+         .filter(Substitution.user_id == user.id, Substitution.lesson_date < before)\
+         .order_by(Substitution.id).limit(BATCH_SIZE).all()
+        if not rows:
+            break
+
+        db.session.bulk_insert_mappings(ArchivedSubstitution, [{
+            'user_id': sub.user_id,
+            'term_start': window_starts(sub.lesson_date)['term'],
+            'lesson_date': sub.lesson_date,
+            'day_of_week': sub.day_of_week,
+            'period_number': sub.period_number,
+            'original_teacher_name': original_name,
+            'covering_teacher_name': covering_name,
+            'covering_teacher_subject': covering_subject,
+        } for sub, original_name, covering_name, covering_subject in rows])
+        Substitution.query.filter(Substitution.id.in_([row[0].id for row in rows]))\
+            .delete(synchronize_session=False)
+        db.session.commit()
+        for sub, *_ in rows:
+            db.session.expunge(sub)
+        moved += len(rows)
+
+    teacher_ids = [t.id for t in Teacher.query.with_entities(Teacher.id).filter_by(user_id=user.id)]
+    if teacher_ids:
+        prune_counters(teacher_ids, before)
+        db.session.commit()
+    return moved
+
+def archived_between(user_id, start, end):
+    """
+    Archived substitutions of a school with start <= lesson_date < end.
+    """
+    return ArchivedSubstitution.query.filter(
+        ArchivedSubstitution.user_id == user_id,
+        ArchivedSubstitution.lesson_date >= start,
+        ArchivedSubstitution.lesson_date < end
+    ).all()
@@ -0,0 +1,128 @@
+"""
+Read latency on /log and /reports while another school re-imports its timetable.
+
+Runs the same workload once per SQLite journal mode (each in a fresh process and a
+fresh database file) and prints latency percentiles and error counts, e.g.:
+
+    python benchmark_reads.py --teachers 300 --duration 10
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+from loadtest import percentile
+from utils import DAYS, PERIODS
+
+def import_timetable(db, Teacher, Slot, user_id, teachers):
+    # Same database work as utils.parse_timetable, without the Excel parsing
+    for t in Teacher.query.filter_by(user_id=user_id).all():
+        db.session.delete(t)
+    db.session.commit()
+    for i in range(teachers):
+        teacher = Teacher(name=f'Teacher {i}', subject='Math', user_id=user_id)
+        db.session.add(teacher)
+        db.session.flush()
+        for day in DAYS:
+            for period in PERIODS:
+                db.session.add(Slot(teacher_id=teacher.id, day_of_week=day,
+                                    period_number=period, has_lesson=(i + period) % 3 != 0))
+    db.session.commit()
+
+def importer(args):
+    # Runs in its own process, like a gunicorn worker handling an upload
+    import app as application
+    from models import db, User, Teacher, Slot
+
+    with application.app.app_context():
+        user_id = User.query.filter_by(username='importer').first().id
+        deadline = time.monotonic() + args.duration
+        count, started = 0, time.perf_counter()
+        while time.monotonic() < deadline:
+            import_timetable(db, Teacher, Slot, user_id, args.teachers)
+            count += 1
+    print(f'{os.environ.get("SQLITE_JOURNAL_MODE"):<8} imports={count} '
+          f'avg_import={(time.perf_counter() - started) / max(count, 1):.2f}s')
+
+def reader(args):
+    from werkzeug.security import generate_password_hash
+    import app as application
+    from models import db, User, Teacher, Slot, Substitution
+
+    app = application.app
+    with app.app_context():
+        application.init_db()
+        reader = User(username='reader', password=generate_password_hash('p'), school_name='A')
+        importer = User(username='importer', password=generate_password_hash('p'), school_name='B')
+        db.session.add_all([reader, importer])
+        db.session.commit()
+        import_timetable(db, Teacher, Slot, reader.id, 60)
+        teachers = Teacher.query.filter_by(user_id=reader.id).all()
+        start = date.today() - timedelta(days=60)
+        for n in range(2000):
+            db.session.add(Substitution(
+                user_id=reader.id,
+                original_teacher_id=teachers[n % 60].id,
+                covering_teacher_id=teachers[(n + 1) % 60].id,
+                day_of_week=DAYS[n % 5], period_number=PERIODS[n % 7],
+                lesson_date=start + timedelta(days=n // 35)))
+        db.session.commit()
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'reader', 'password': 'p'})
+    month = date.today().strftime('%Y-%m')
+    urls = ['/log', f'/reports?type=month&date={month}']
+
+    import_process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--importer',
+                                       '--teachers', str(args.teachers), '--duration', str(args.duration)])
+    latencies = {url: [] for url in urls}
+    errors = 0
+    deadline = time.monotonic() + args.duration
+    while time.monotonic() < deadline:
+        for url in urls:
+            t0 = time.perf_counter()
+            try:
+                ok = client.get(url).status_code == 200
+            except Exception:
+                ok = False
+            if ok:
+                latencies[url].append((time.perf_counter() - t0) * 1000)
+            else:
+                errors += 1
+    import_process.wait()
+
+    mode = os.environ.get('SQLITE_JOURNAL_MODE')
+    for url, values in latencies.items():
+        print(f'{mode:<8} {url:<28} n={len(values):<5} p50={percentile(values, 50):7.1f}ms '
+              f'p95={percentile(values, 95):7.1f}ms max={max(values, default=0):7.1f}ms')
+    print(f'{mode:<8} errors={errors}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--teachers', type=int, default=300, help='teachers per import')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of reads per mode')
+    parser.add_argument('--modes', default='DELETE,WAL', help='SQLite journal modes to compare')
+    parser.add_argument('--reader', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--importer', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.reader:
+        return reader(args)
+    if args.importer:
+        return importer(args)
+
+    for mode in args.modes.split(','):
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(os.environ,
+                       DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'bench.db')}",
+                       SQLITE_JOURNAL_MODE=mode)
+            env.pop('DATABASE_REPLICA_URL', None)
+            subprocess.run([sys.executable, os.path.abspath(__file__), '--reader',
+                            '--teachers', str(args.teachers), '--duration', str(args.duration)],
+                           env=env, cwd=tmp, check=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import os
+from collections import Counter
+from datetime import date, timedelta
+from sqlalchemy import table, column, select, delete, Integer, Date
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, SubstitutionCounter
+
+# Per-teacher substitution counters over rolling calendar windows. Each window is
+# identified by its start date, so last month's counts simply stop being read
+# instead of having to be reset.
+
+SPANS = ('week', 'month', 'term')
+
+# Python weekday the school week starts on (6 = Sunday)
+WEEK_START_DAY = int(os.environ.get('WEEK_START_DAY', 6))
+
+# Term start dates as MM-DD, repeated every year
+TERM_STARTS = [
+    tuple(map(int, md.split('-')))
+    for md in os.environ.get('TERM_STARTS', '09-01,02-01').split(',')
+]
+
+# Window that substitution_quota is measured against
+QUOTA_SPAN = os.environ.get('QUOTA_SPAN', 'term')
+
+def window_starts(day):
+    """
+    Returns {span: start date} of the week, month and term that contain the given date.
+    """
+    term_starts = [date(year, month, dd) for year in (day.year - 1, day.year) for month, dd in TERM_STARTS]
+    return {
+        'week': day - timedelta(days=(day.weekday() - WEEK_START_DAY) % 7),
+        'month': day.replace(day=1),
+        'term': max(start for start in term_starts if start <= day),
+    }
+
+def bump_counters(teacher_id, lesson_date, delta):
+    """
+    Adds delta to the teacher's counters for every window containing lesson_date.
+    Uses an atomic upsert, so concurrent assigns never lose an increment.
+    """
+    counters = SubstitutionCounter.__table__
+    insert = postgresql.insert if db.engine.dialect.name == 'postgresql' else sqlite.insert
+    stmt = insert(counters).values([
+        {'teacher_id': teacher_id, 'span': span, 'period_start': start, 'count': delta}
+        for span, start in window_starts(lesson_date).items()
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['teacher_id', 'span', 'period_start'],
+        set_={'count': counters.c.count + stmt.excluded.count},
+    )
+    db.session.execute(stmt)
+
+def counters_for(teacher_ids, day):
+    """
+    Returns {teacher_id: {span: count}} for the windows containing the given date,
+    in a single indexed query.
+    """
+    starts = window_starts(day)
+    result = {teacher_id: dict.fromkeys(SPANS, 0) for teacher_id in teacher_ids}
+    if not result:
+        return result
+    rows = SubstitutionCounter.query.filter(
+        SubstitutionCounter.teacher_id.in_(result.keys()),
+        db.or_(*[
+            db.and_(SubstitutionCounter.span == span, SubstitutionCounter.period_start == start)
+            for span, start in starts.items()
+        ])
+    ).all()
+    for row in rows:
+        result[row.teacher_id][row.span] = row.count
+    return result
+
+def quota_usage(counts, quota):
+    """
+    Fraction of the teacher's substitution quota already used; 0 when no quota is set.
+    """
+    return counts[QUOTA_SPAN] / quota if quota else 0
+
+def rebuild_counters():
+    """
+    Recomputes every counter from the substitution table.
+    """
+    sub = table('substitution', column('covering_teacher_id', Integer), column('lesson_date', Date))
+    totals = Counter()
+    with db.engine.begin() as conn:
+        for teacher_id, lesson_date in conn.execute(select(sub.c.covering_teacher_id, sub.c.lesson_date)):
+            for span, start in window_starts(lesson_date).items():
+                totals[(teacher_id, span, start)] += 1
+        conn.execute(delete(SubstitutionCounter.__table__))
+        if totals:
+            conn.execute(SubstitutionCounter.__table__.insert(), [
+                {'teacher_id': teacher_id, 'span': span, 'period_start': start, 'count': count}
+                for (teacher_id, span, start), count in totals.items()
+            ])
+
+def prune_counters(teacher_ids, before):
+    """
+    Drops counters for windows that ended before the given date; they are never read again.
+    """
+    starts = window_starts(before)
+    SubstitutionCounter.query.filter(
+        SubstitutionCounter.teacher_id.in_(teacher_ids),
+        db.or_(*[
+            db.and_(SubstitutionCounter.span == span, SubstitutionCounter.period_start < start)
+            for span, start in starts.items()
+        ])
+    ).delete(synchronize_session=False)
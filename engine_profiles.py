@@ -0,0 +1,85 @@
+import os
+import sqlite3
+from functools import wraps
+from flask import g, has_app_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Engine tuning, configured through environment variables so the same code runs
+# against the local SQLite file and the hosted Postgres database.
+
+SQLITE_PROFILE = {
+    'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),
+    'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+}
+
+POSTGRES_PROFILE = {
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') != '0',
+    'statement_timeout': int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 15000)),
+}
+
+def normalize_url(url):
+    """
+    Railway and Heroku still hand out postgres:// URLs, which SQLAlchemy rejects.
+    """
+    if url and url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    return url
+
+def engine_options(database_url):
+    """
+    Returns SQLALCHEMY_ENGINE_OPTIONS for the given database URL.
+    SQLite pragmas are applied per connection by the listener below.
+    """
+    if database_url.startswith('sqlite'):
+        # sqlite3's own lock wait, in seconds; kept in line with busy_timeout
+        return {'connect_args': {'timeout': SQLITE_PROFILE['busy_timeout'] / 1000}}
+
+    profile = POSTGRES_PROFILE
+    return {
+        'pool_size': profile['pool_size'],
+        'max_overflow': profile['max_overflow'],
+        'pool_recycle': profile['pool_recycle'],
+        'pool_pre_ping': profile['pool_pre_ping'],
+        'connect_args': {'options': f"-c statement_timeout={profile['statement_timeout']}"},
+    }
+
+@event.listens_for(Engine, 'connect')
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    profile = SQLITE_PROFILE
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={profile['journal_mode']}")
+    cursor.execute(f"PRAGMA busy_timeout={profile['busy_timeout']}")
+    cursor.execute(f"PRAGMA synchronous={profile['synchronous']}")
+    cursor.execute(f"PRAGMA mmap_size={profile['mmap_size']}")
+    cursor.close()
+
+class RoutingSession(Session):
+    """
+    Sends reads to the 'replica' bind while a view decorated with use_replica runs.
+    Flushes always go to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and has_app_context()
+                and g.get('use_replica') and 'replica' in self._db.engines):
+            return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def use_replica(view):
+    """
+    Marks a read-only view so its queries run against DATABASE_REPLICA_URL, if configured.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.use_replica = True
+        return view(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,94 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from models import db, SubstitutionEvent
+
+# Live substitution feed. Changes are written to substitution_event alongside the
+# substitution itself, and each open /events stream polls that table by id. This
+# works the same across gunicorn workers and on both SQLite and Postgres.
+
+POLL_INTERVAL = float(os.environ.get('EVENTS_POLL_INTERVAL', 2))
+
+# Thread budget: a held stream occupies one worker thread for up to STREAM_TTL
+# seconds, then the browser reconnects with Last-Event-ID. At most MAX_STREAMS
+# streams are held per worker process; with the Procfile's 8 gthread threads that
+# leaves 4 threads per worker that streams can never take. Connections over the
+# cap get one poll's worth of events and are closed at once, so the browser falls
+# back to short polling every FALLBACK_RETRY seconds.
+STREAM_TTL = float(os.environ.get('EVENTS_STREAM_TTL', 30))
+MAX_STREAMS = int(os.environ.get('EVENTS_MAX_STREAMS', 4))
+FALLBACK_RETRY = float(os.environ.get('EVENTS_FALLBACK_RETRY', 5))
+
+_stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+
+RETENTION = timedelta(hours=int(os.environ.get('EVENTS_RETENTION_HOURS', 24)))
+
+def substitution_delta(sub):
+    return {
+        'id': sub.id,
+        'lesson_date': sub.lesson_date.isoformat(),
+        'day': sub.day_of_week,
+        'period': int(sub.period_number),
+        'original_teacher_id': int(sub.original_teacher_id),
+        'original_teacher': sub.original_teacher.name,
+        'covering_teacher_id': int(sub.covering_teacher_id),
+        'covering_teacher': sub.covering_teacher.name,
+        'covering_subject': sub.covering_teacher.subject,
+    }
+
+def record_event(sub, kind):
+    """
+    Queues an 'assigned' or 'deleted' event for the substitution's school.
+    Must be called before the surrounding commit so both land together.
+    """
+    db.session.add(SubstitutionEvent(
+        user_id=sub.user_id,
+        kind=kind,
+        payload=json.dumps({'type': kind, 'substitution': substitution_delta(sub)}, ensure_ascii=False),
+    ))
+    SubstitutionEvent.query.filter(
+        SubstitutionEvent.user_id == sub.user_id,
+        SubstitutionEvent.created_at < datetime.utcnow() - RETENTION
+    ).delete(synchronize_session=False)
+
+def latest_event_id(user_id):
+    """
+    Id to resume from when a page is rendered, so nothing between render and connect is missed.
+    """
+    return db.session.query(db.func.max(SubstitutionEvent.id)).filter(
+        SubstitutionEvent.user_id == user_id).scalar() or 0
+
+def event_stream(user_id, last_id):
+    """
+    Yields server-sent events for the school newer than last_id. Holds the connection
+    until STREAM_TTL passes if a stream slot is free, otherwise answers a single poll.
+    """
+    held = MAX_STREAMS > 0 and _stream_slots.acquire(blocking=False)
+    try:
+        yield from _poll_events(user_id, last_id, held)
+    finally:
+        if held:
+            _stream_slots.release()
+
+def _poll_events(user_id, last_id, held):
+    retry = POLL_INTERVAL if held else FALLBACK_RETRY
+    yield f'retry: {int(retry * 1000)}\n\n'
+    deadline = time.monotonic() + (STREAM_TTL if held else 0)
+    while True:
+        rows = db.session.query(SubstitutionEvent.id, SubstitutionEvent.payload).filter(
+            SubstitutionEvent.user_id == user_id,
+            SubstitutionEvent.id > last_id
+        ).order_by(SubstitutionEvent.id).all()
+        # Hand the connection back to the pool while idle
+        db.session.close()
+        for event_id, payload in rows:
+            last_id = event_id
+            yield f'id: {event_id}\ndata: {payload}\n\n'
+        if time.monotonic() >= deadline:
+            return
+        if not rows:
+            # Comment line; keeps proxies from closing an idle connection
+            yield ': keep-alive\n\n'
+        time.sleep(POLL_INTERVAL)
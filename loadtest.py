@@ -0,0 +1,372 @@
+"""
+Morning-peak load test: many schools' coordinators on /find and /assign at once,
+while some schools re-upload their timetables.
+
+Seeds N schools with synthetic timetables, starts gunicorn locally (SQLite by
+default, or the database given with --database-url), runs concurrent scripted
+sessions and prints throughput, latency percentiles and error rates per endpoint:
+
+    python loadtest.py --schools 20 --sessions 40 --duration 60 --workers 4 --threads 8
+    python loadtest.py --database-url postgresql://localhost/timetable_load --workers 8
+
+Only the standard library, openpyxl and gunicorn are needed on top of the app.
+"""
+import argparse
+import http.cookiejar
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from collections import defaultdict
+from datetime import date, timedelta
+
+from openpyxl import Workbook
+
+from utils import DAYS, PERIODS, next_date_for_day
+
+PASSWORD = 'loadtest'
+
+def percentile(values, p):
+    # Shared with benchmark_reads.py
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def write_timetable(path, teachers, seed):
+    """
+    Writes a timetable in the two-row layout utils.parse_timetable handles: the
+    teacher name header with a day name above each block of periods, then a row
+    with the period numbers.
+    """
+    rng = random.Random(seed)
+    wb = Workbook()
+    ws = wb.active
+    days_row = ['اسم المدرس', 'المادة', 'عدد الحصص']
+    for day in DAYS:
+        days_row += [day] + [None] * (len(PERIODS) - 1)
+    ws.append(days_row)
+    ws.append([None, None, None] + PERIODS * len(DAYS))
+    for i in range(teachers):
+        lessons = [rng.choice(['1/أ', '2/ب', '3/ج']) if rng.random() < 0.6 else None
+                   for _ in range(len(DAYS) * len(PERIODS))]
+        ws.append([f'معلم {i + 1}', rng.choice(['رياضيات', 'علوم', 'لغة عربية', 'إنجليزي']),
+                   sum(1 for x in lessons if x)] + lessons)
+    wb.save(path)
+
+def check_timetable(path, teachers):
+    """
+    Parses the workbook with the app's own parser against an in-memory database and
+    fails unless every teacher comes out with exactly one slot per day and period.
+    """
+    from flask import Flask
+    from models import db, Teacher, Slot
+    from utils import parse_timetable
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        ok, message = parse_timetable(path, user_id=1)
+        parsed = Teacher.query.count()
+        slots = {(s.teacher_id, s.day_of_week, s.period_number) for s in Slot.query.all()}
+        slot_count = Slot.query.count()
+    expected = teachers * len(DAYS) * len(PERIODS)
+    if not ok or parsed != teachers or slot_count != expected or len(slots) != expected:
+        raise SystemExit(f'Synthetic timetable does not parse cleanly: {message}; '
+                         f'{parsed}/{teachers} teachers, {slot_count} slots '
+                         f'({len(slots)} distinct), expected {expected}')
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+class Session:
+    """
+    One coordinator's browser: a cookie jar and timing of every request.
+    """
+
+    def __init__(self, base_url, stats):
+        self.base_url = base_url
+        self.stats = stats
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect)
+
+    def request(self, name, path, data=None, body=None, content_type=None, record=True,
+                expected=(200,), headers=None):
+        if data is not None:
+            body = urllib.parse.urlencode(data).encode()
+            content_type = 'application/x-www-form-urlencoded'
+        req = urllib.request.Request(self.base_url + path, data=body, headers=headers or {})
+        if content_type:
+            req.add_header('Content-Type', content_type)
+        t0 = time.perf_counter()
+        try:
+            with self.opener.open(req, timeout=60) as resp:
+                status, text = resp.status, resp.read().decode('utf-8', 'replace')
+        except urllib.error.HTTPError as e:
+            status, text = e.code, ''
+        except (urllib.error.URLError, OSError):
+            status, text = 0, ''
+        if record:
+            self.stats.record(name, time.perf_counter() - t0, status, expected)
+        return status, text
+
+    def login(self, username):
+        # A successful login redirects; a failed one re-renders the form with 200
+        return self.request('login', '/login', {'username': username, 'password': PASSWORD},
+                            expected=(302,))
+
+    def upload(self, path):
+        boundary = uuid.uuid4().hex
+        with open(path, 'rb') as f:
+            content = f.read()
+        body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; '
+                f'filename="{os.path.basename(path)}"\r\n'
+                'Content-Type: application/vnd.openxmlformats-officedocument.spreadsheetml.sheet\r\n\r\n'
+                ).encode() + content + f'\r\n--{boundary}--\r\n'.encode()
+        t0 = time.perf_counter()
+        status, _ = self.request('upload', '/upload', body=body, record=False,
+                                 content_type=f'multipart/form-data; boundary={boundary}')
+        # /upload redirects either way; whether the import worked is only in the flash message
+        if status == 302:
+            _, page = self.request('upload', '/', record=False)
+            if 'Error processing file' in page or 'Timetable uploaded' not in page:
+                status = 500
+        self.stats.record('upload', time.perf_counter() - t0, status, expected=(302,))
+        return status
+
+class Stats:
+    """
+    Per endpoint: latencies of expected answers, conflicts (409/422 from /assign,
+    the app correctly refusing a double booking) and errors (anything else,
+    including a redirect to /login after a lost session).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.conflicts = defaultdict(int)
+        self.errors = defaultdict(int)
+
+    def record(self, name, seconds, status, expected=(200,)):
+        with self.lock:
+            if status in expected:
+                self.latencies[name].append(seconds * 1000)
+            elif status in (409, 422):
+                self.conflicts[name] += 1
+            else:
+                self.errors[name] += 1
+
+    def report(self, elapsed):
+        print(f"\n{'endpoint':<10} {'ok':>7} {'confl':>6} {'err':>5} {'err%':>6} {'req/s':>7} "
+              f"{'p50':>8} {'p95':>8} {'p99':>8}")
+        total_ok = total_conflicts = total_err = 0
+        for name in sorted(set(self.latencies) | set(self.conflicts) | set(self.errors)):
+            values, conflicts, errors = self.latencies[name], self.conflicts[name], self.errors[name]
+            total_ok += len(values)
+            total_conflicts += conflicts
+            total_err += errors
+            count = len(values) + conflicts + errors
+            print(f'{name:<10} {len(values):>7} {conflicts:>6} {errors:>5} {100 * errors / count:>5.1f}% '
+                  f'{count / elapsed:>7.1f} {percentile(values, 50):>6.0f}ms '
+                  f'{percentile(values, 95):>6.0f}ms {percentile(values, 99):>6.0f}ms')
+        total = total_ok + total_conflicts + total_err
+        print(f"{'total':<10} {total_ok:>7} {total_conflicts:>6} {total_err:>5} "
+              f"{100 * total_err / max(total, 1):>5.1f}% {total / elapsed:>7.1f}")
+
+def lesson_date_for(day, rng):
+    # A date in the next few weeks that falls on the given school day
+    return next_date_for_day(day, date.today() + timedelta(days=rng.randint(0, 28)))
+
+def listen_events(session, deadline):
+    """
+    Keeps the session's /events stream open the way a browser's EventSource does:
+    read until the server closes it, wait the advertised retry, reconnect with
+    Last-Event-ID. Records time to the first byte of each connection as 'events'.
+    """
+    last_id, retry = None, 2.0
+    while time.monotonic() < deadline:
+        req = urllib.request.Request(session.base_url + '/events')
+        if last_id:
+            req.add_header('Last-Event-ID', last_id)
+        t0 = time.perf_counter()
+        try:
+            with session.opener.open(req, timeout=120) as resp:
+                session.stats.record('events', time.perf_counter() - t0, resp.status)
+                for line in resp:
+                    line = line.decode('utf-8', 'replace').strip()
+                    if line.startswith('id:'):
+                        last_id = line[3:].strip()
+                    elif line.startswith('retry:'):
+                        retry = int(line[6:]) / 1000
+                    if time.monotonic() >= deadline:
+                        return
+        except urllib.error.HTTPError as e:
+            session.stats.record('events', time.perf_counter() - t0, e.code)
+        except (urllib.error.URLError, OSError):
+            if time.monotonic() < deadline:
+                session.stats.record('events', time.perf_counter() - t0, 0)
+        time.sleep(retry)
+
+def coordinator(base_url, school, upload_school, stats, deadline, args, seed):
+    """
+    A scripted coordinator session: find and assign substitutes, check the log and
+    reports, and now and then re-upload the timetable of an upload-only school.
+    """
+    rng = random.Random(seed)
+    session = Session(base_url, stats)
+    session.login(school)
+    # Re-importing a school that has substitutions fails (its teachers are still
+    # referenced), so imports go to schools that never get assignments.
+    uploader = None
+    if not args.no_events:
+        # Like an open log or results page; daemon so a held stream never delays the report
+        threading.Thread(target=listen_events, args=(session, deadline), daemon=True).start()
+    status, page = session.request('find', '/find')
+    block = page.split('id="teacher_id"', 1)[-1].split('</select>', 1)[0]
+    teacher_ids = re.findall(r'<option value="(\d+)"', block)
+
+    while time.monotonic() < deadline:
+        if upload_school and rng.random() < args.upload_ratio:
+            if uploader is None:
+                uploader = Session(base_url, stats)
+                uploader.login(upload_school[0])
+            uploader.upload(upload_school[1])
+        if not teacher_ids:
+            time.sleep(0.1)
+            continue
+
+        day = rng.choice(DAYS)
+        teacher_id = rng.choice(teacher_ids)
+        status, page = session.request('find', '/find', {
+            'teacher_id': teacher_id, 'day': day, 'period': rng.choice(PERIODS),
+            'lesson_date': lesson_date_for(day, rng).isoformat(),
+            'rank': rng.choice(['load', 'fairness']),
+        })
+        forms = re.findall(r'<form action="/assign".*?</form>', page, re.S)
+        if forms:
+            fields = dict(re.findall(r'name="(\w+)" value="([^"]*)"', rng.choice(forms)))
+            # Ask for JSON so a double booking comes back as 409 rather than a redirect
+            session.request('assign', '/assign', fields, expected=(200, 201),
+                            headers={'Accept': 'application/json'})
+
+        if rng.random() < 0.3:
+            session.request('log', '/log')
+        if rng.random() < 0.15:
+            session.request('reports', f'/reports?type=month&date={date.today():%Y-%m}')
+        time.sleep(rng.uniform(0, args.think_time))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base_url + '/login', timeout=2)
+            return
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.3)
+    raise RuntimeError(f'server at {base_url} did not start')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--schools', type=int, default=10)
+    parser.add_argument('--teachers', type=int, default=40, help='teachers per school')
+    parser.add_argument('--sessions', type=int, default=20, help='concurrent coordinator sessions')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    # Defaults match the Procfile, so a plain run measures the deployed configuration
+    parser.add_argument('--workers', type=int, default=1, help='gunicorn worker processes')
+    parser.add_argument('--worker-class', default='gthread', help='gunicorn worker class')
+    parser.add_argument('--threads', type=int, default=8, help='gunicorn threads per worker')
+    parser.add_argument('--no-events', action='store_true',
+                        help='do not keep an /events stream open per session')
+    parser.add_argument('--upload-schools', type=int, default=2,
+                        help='extra schools that only ever re-upload their timetables')
+    parser.add_argument('--upload-ratio', type=float, default=0.01,
+                        help='chance per iteration that a session re-uploads an upload-only timetable')
+    parser.add_argument('--think-time', type=float, default=0.5, help='max pause between actions (s)')
+    parser.add_argument('--database-url', help='defaults to a fresh SQLite file')
+    parser.add_argument('--base-url', help='use an already running server instead of starting gunicorn')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='loadtest-')
+    server = None
+    base_url = args.base_url
+    if not base_url:
+        port = free_port()
+        base_url = f'http://127.0.0.1:{port}'
+        # Run from the temp dir so uploads and the SQLite file stay out of the repo
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)),
+                   DATABASE_URL=args.database_url or f"sqlite:///{os.path.join(tmp, 'load.db')}")
+        subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'],
+                       cwd=tmp, env=env, check=True)
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', 'app:app', '-b', f'127.0.0.1:{port}',
+             '-w', str(args.workers), '-k', args.worker_class, '--threads', str(args.threads),
+             '--log-level', 'warning'],
+            cwd=tmp, env=env)
+    try:
+        wait_for(base_url)
+
+        # Seed: one account and timetable per school, uploaded through the app itself
+        print(f'Seeding {args.schools} + {args.upload_schools} upload-only schools '
+              f'x {args.teachers} teachers ...')
+        seed_stats = Stats()
+        run_id = uuid.uuid4().hex[:6]
+        schools, upload_schools = [], []
+        for i in range(args.schools + args.upload_schools):
+            name = f"{'load' if i < args.schools else 'upload'}-{run_id}-{i}"
+            path = os.path.join(tmp, f'{name}.xlsx')
+            write_timetable(path, args.teachers, seed=i)
+            if i == 0:
+                check_timetable(path, args.teachers)
+            session = Session(base_url, seed_stats)
+            session.request('register', '/register',
+                            {'username': name, 'password': PASSWORD, 'school_name': name},
+                            expected=(302,))
+            session.login(name)
+            if session.upload(path) != 302:
+                raise SystemExit(f'Seeding failed: could not import the timetable for {name}')
+            (schools if i < args.schools else upload_schools).append((name, path))
+
+        print(f'Running {args.sessions} sessions for {args.duration:.0f}s '
+              f'({args.workers} {args.worker_class} workers x {args.threads} threads'
+              f"{'' if args.no_events else ', one /events stream each'}) ...")
+        stats = Stats()
+        deadline = time.monotonic() + args.duration
+        started = time.monotonic()
+        threads = [
+            threading.Thread(target=coordinator, args=(
+                base_url, schools[n % len(schools)][0],
+                upload_schools[n % len(upload_schools)] if upload_schools else None,
+                stats, deadline, args, n))
+            for n in range(args.sessions)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats.report(time.monotonic() - started)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
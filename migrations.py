@@ -0,0 +1,126 @@
+import logging
+from sqlalchemy import inspect, text, table, column, select, update, bindparam, Integer, String, Date, DateTime
+from models import db
+from utils import school_tz, local_date_from_utc, next_date_for_day
+from counters import rebuild_counters
+
+# db.create_all() only creates missing tables; it never alters existing ones.
+# Each step below is idempotent and brings an older database up to the current models.
+# Steps use lightweight table() definitions rather than the ORM models, which may
+# already contain columns added by later steps.
+
+logger = logging.getLogger(__name__)
+
+def _columns(table):
+    return {c['name'] for c in inspect(db.engine).get_columns(table)}
+
+def _indexes(table):
+    return {i['name'] for i in inspect(db.engine).get_indexes(table)}
+
+def _add_column(table, ddl):
+    with db.engine.begin() as conn:
+        conn.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {ddl}'))
+
+def add_lesson_date():
+    """
+    Adds user.timezone, substitution.user_id and substitution.lesson_date, and backfills
+    existing rows: the school comes from the original teacher, the lesson date is the
+    first day matching day_of_week on or after created_at in the school's local timezone.
+    """
+    if 'timezone' not in _columns('user'):
+        _add_column('user', 'timezone VARCHAR(64)')
+
+    columns = _columns('substitution')
+    if 'user_id' not in columns:
+        _add_column('substitution', 'user_id INTEGER REFERENCES "user" (id)')
+    if 'lesson_date' not in columns:
+        _add_column('substitution', 'lesson_date DATE')
+
+    sub = table('substitution', column('id', Integer), column('user_id', Integer),
+                column('original_teacher_id', Integer), column('day_of_week', String),
+                column('lesson_date', Date), column('created_at', DateTime))
+    user = table('user', column('id', Integer), column('timezone', String))
+    teacher = table('teacher', column('id', Integer), column('user_id', Integer))
+
+    with db.engine.begin() as conn:
+        pending = conn.execute(select(sub).where(
+            db.or_(sub.c.user_id.is_(None), sub.c.lesson_date.is_(None))
+        )).all()
+        if pending:
+            zones = {row.id: school_tz(row) for row in conn.execute(select(user))}
+            owners = dict(conn.execute(select(teacher.c.id, teacher.c.user_id)).all())
+            for row in pending:
+                user_id = row.user_id or owners.get(row.original_teacher_id)
+                # Substitutions are assigned ahead of the lesson, so the lesson is the
+                # first matching weekday on or after the (local) assignment date.
+                lesson_date = row.lesson_date or next_date_for_day(row.day_of_week, local_date_from_utc(
+                    row.created_at, zones.get(user_id) or school_tz(None)))
+                conn.execute(update(sub).where(sub.c.id == row.id)
+                             .values(user_id=user_id, lesson_date=lesson_date))
+
+    if 'ix_substitution_user_lesson_date' not in _indexes('substitution'):
+        with db.engine.begin() as conn:
+            conn.execute(text(
+                'CREATE INDEX ix_substitution_user_lesson_date ON substitution (user_id, lesson_date)'
+            ))
+
+def add_assignment_constraints():
+    """
+    Adds substitution.idempotency_key and the unique indexes that stop a teacher being
+    double-booked or a lesson being covered twice. Rows that collide with an earlier
+    assignment are moved to quarantined_substitution (never deleted) and logged.
+    """
+    if 'idempotency_key' not in _columns('substitution'):
+        _add_column('substitution', 'idempotency_key VARCHAR(64)')
+
+    fields = 'id, user_id, original_teacher_id, covering_teacher_id, day_of_week, period_number, lesson_date, created_at'
+    indexes = _indexes('substitution')
+    for name, columns in [
+        ('uq_substitution_covering_slot', 'covering_teacher_id, lesson_date, period_number'),
+        ('uq_substitution_original_slot', 'original_teacher_id, lesson_date, period_number'),
+    ]:
+        if name in indexes:
+            continue
+        with db.engine.begin() as conn:
+            conflicts = [row[0] for row in conn.execute(text(
+                f'SELECT id FROM substitution WHERE id NOT IN '
+                f'(SELECT MIN(id) FROM substitution GROUP BY {columns})'
+            ))]
+            if conflicts:
+                ids = {'ids': conflicts}
+                conn.execute(text(
+                    f'INSERT INTO quarantined_substitution ({fields}, reason, quarantined_at) '
+                    f'SELECT {fields}, :reason, CURRENT_TIMESTAMP FROM substitution WHERE id IN :ids'
+                ).bindparams(bindparam('ids', expanding=True)), dict(ids, reason=name))
+                conn.execute(text('DELETE FROM substitution WHERE id IN :ids')
+                             .bindparams(bindparam('ids', expanding=True)), ids)
+                logger.warning('Moved %d substitutions violating %s to quarantined_substitution: ids %s',
+                               len(conflicts), name, conflicts)
+            conn.execute(text(f'CREATE UNIQUE INDEX {name} ON substitution ({columns})'))
+
+    # The key column is new, so there is nothing to deduplicate here
+    if 'uq_substitution_idempotency_key' not in indexes:
+        with db.engine.begin() as conn:
+            conn.execute(text(
+                'CREATE UNIQUE INDEX uq_substitution_idempotency_key ON substitution (user_id, idempotency_key)'
+            ))
+
+def backfill_substitution_counters():
+    """
+    Fills the substitution_counter table (created by db.create_all) from existing history.
+    """
+    with db.engine.connect() as conn:
+        has_counters = conn.execute(text('SELECT 1 FROM substitution_counter LIMIT 1')).first()
+        has_history = conn.execute(text('SELECT 1 FROM substitution LIMIT 1')).first()
+    if has_history and not has_counters:
+        rebuild_counters()
+
+MIGRATIONS = [
+    add_lesson_date,
+    add_assignment_constraints,
+    backfill_substitution_counters,
+]
+
+def run_migrations():
+    for migration in MIGRATIONS:
+        migration()
@@ -1,14 +1,18 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime
+from types import SimpleNamespace
+from engine_profiles import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(150), unique=True, nullable=False)
     school_name = db.Column(db.String(200))
     password = db.Column(db.String(150), nullable=False)
+    # Optional per-school override; NULL follows SCHOOL_TIMEZONE (utils.DEFAULT_TIMEZONE)
+    timezone = db.Column(db.String(64))
     teachers = db.relationship('Teacher', backref='owner', lazy=True, cascade="all, delete-orphan")
 
 class Teacher(db.Model):
@@ -20,6 +24,7 @@ class Teacher(db.Model):
     substitution_quota = db.Column(db.Integer, default=0)
     is_excluded = db.Column(db.Boolean, default=False)
     slots = db.relationship('Slot', backref='teacher', lazy=True, cascade="all, delete-orphan")
+    counters = db.relationship('SubstitutionCounter', backref='teacher', lazy=True, passive_deletes=True)
 
     def __repr__(self):
         return f'<Teacher {self.name}>'
@@ -36,15 +41,115 @@ class Slot(db.Model):
 
 class Substitution(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    # School scope, denormalized from the original teacher so reports can range-scan without a join
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     original_teacher_id = db.Column(db.Integer, db.ForeignKey('teacher.id'), nullable=False)
     covering_teacher_id = db.Column(db.Integer, db.ForeignKey('teacher.id'), nullable=False)
     day_of_week = db.Column(db.String(20), nullable=False)
     period_number = db.Column(db.Integer, nullable=False)
+    # Calendar date of the covered lesson (school local time), as opposed to when it was assigned
+    lesson_date = db.Column(db.Date, nullable=False)
+    # Client-generated key so a double-submitted assign form is only applied once
+    idempotency_key = db.Column(db.String(64))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
     # Relationships for easy access
     original_teacher = db.relationship('Teacher', foreign_keys=[original_teacher_id], backref='substitutions_requested')
     covering_teacher = db.relationship('Teacher', foreign_keys=[covering_teacher_id], backref='substitutions_covered')
 
+    __table_args__ = (
+        db.Index('ix_substitution_user_lesson_date', 'user_id', 'lesson_date'),
+        # A teacher can cover only one class per period, and a class is covered only once
+        db.Index('uq_substitution_covering_slot', 'covering_teacher_id', 'lesson_date', 'period_number', unique=True),
+        db.Index('uq_substitution_original_slot', 'original_teacher_id', 'lesson_date', 'period_number', unique=True),
+        db.Index('uq_substitution_idempotency_key', 'user_id', 'idempotency_key', unique=True),
+    )
+
+    def __repr__(self):
+        return f'<Substitution {self.lesson_date} {self.day_of_week} P{self.period_number}>'
+
+class QuarantinedSubstitution(db.Model):
+    """
+    Substitution that broke a uniqueness rule when the constraints were added, moved
+    aside by migrations.py instead of being deleted. Review and re-enter by hand.
+    """
+    id = db.Column(db.Integer, primary_key=True)  # id the row had in substitution
+    user_id = db.Column(db.Integer)
+    original_teacher_id = db.Column(db.Integer)
+    covering_teacher_id = db.Column(db.Integer)
+    day_of_week = db.Column(db.String(20))
+    period_number = db.Column(db.Integer)
+    lesson_date = db.Column(db.Date)
+    created_at = db.Column(db.DateTime)
+    reason = db.Column(db.String(64), nullable=False)
+    quarantined_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<QuarantinedSubstitution {self.id} {self.reason}>'
+
+class SubstitutionCounter(db.Model):
+    """
+    Substitutions covered by a teacher within one window (week, month or term),
+    kept up to date on assign and delete so ranking never has to count history.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    teacher_id = db.Column(db.Integer, db.ForeignKey('teacher.id', ondelete='CASCADE'), nullable=False)
+    span = db.Column(db.String(10), nullable=False)  # 'week', 'month' or 'term'
+    period_start = db.Column(db.Date, nullable=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.UniqueConstraint('teacher_id', 'span', 'period_start', name='uq_substitution_counter'),
+    )
+
+    def __repr__(self):
+        return f'<SubstitutionCounter {self.teacher_id} {self.span} {self.period_start}: {self.count}>'
+
+class SubstitutionEvent(db.Model):
+    """
+    Outbox of assigned/deleted substitutions per school, written in the same
+    transaction as the change and streamed to open pages over /events.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)  # 'assigned' or 'deleted'
+    payload = db.Column(db.Text, nullable=False)  # JSON delta sent to clients as-is
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_substitution_event_user_id', 'user_id', 'id'),
+    )
+
+    def __repr__(self):
+        return f'<SubstitutionEvent {self.id} {self.kind}>'
+
+class ArchivedSubstitution(db.Model):
+    """
+    Substitution from a closed term, moved out of the hot table by archive.py.
+    Teacher names are copied in because a timetable re-upload replaces the teachers.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    term_start = db.Column(db.Date, nullable=False)
+    lesson_date = db.Column(db.Date, nullable=False)
+    day_of_week = db.Column(db.String(20), nullable=False)
+    period_number = db.Column(db.Integer, nullable=False)
+    original_teacher_name = db.Column(db.String(100))
+    covering_teacher_name = db.Column(db.String(100))
+    covering_teacher_subject = db.Column(db.String(100))
+
+    __table_args__ = (
+        db.Index('ix_archived_substitution_user_lesson_date', 'user_id', 'lesson_date'),
+    )
+
+    # Same attributes the report templates read from a live Substitution
+    @property
+    def original_teacher(self):
+        return SimpleNamespace(name=self.original_teacher_name, subject=None)
+
+    @property
+    def covering_teacher(self):
+        return SimpleNamespace(name=self.covering_teacher_name, subject=self.covering_teacher_subject)
+
     def __repr__(self):
-        return f'<Substitution {self.day_of_week} P{self.period_number}>'
\ No newline at end of file
+        return f'<ArchivedSubstitution {self.lesson_date} {self.day_of_week} P{self.period_number}>'
\ No newline at end of file
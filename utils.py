@@ -1,5 +1,7 @@
 import pandas as pd
 import os
+from datetime import datetime, date, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from models import db, Teacher, Slot
 
 # Arabic Day Names to English (for internal storage if needed, or keep Arabic)
@@ -12,8 +14,87 @@ DAYS_MAP = {
     'الخميس': 'Thursday'
 }
 
+# School days in order, in their usual spelling
+DAYS = ['الأحد', 'الإثنين', 'الثلاثاء', 'الأربعاء', 'الخميس']
+
 PERIODS = [1, 2, 3, 4, 5, 6, 7]
 
+DEFAULT_TIMEZONE = os.environ.get('SCHOOL_TIMEZONE', 'Asia/Riyadh')
+
+def school_tz(user):
+    """
+    Returns the ZoneInfo of the user's school, falling back to the default timezone.
+    """
+    try:
+        return ZoneInfo(getattr(user, 'timezone', None) or DEFAULT_TIMEZONE)
+    except (ZoneInfoNotFoundError, ValueError):
+        return ZoneInfo(DEFAULT_TIMEZONE)
+
+def school_today(user):
+    """
+    Returns today's date in the school's local timezone.
+    """
+    return datetime.now(school_tz(user)).date()
+
+def local_date_from_utc(dt, tz):
+    """
+    Converts a naive UTC datetime (as stored in created_at) to a local calendar date.
+    """
+    return dt.replace(tzinfo=timezone.utc).astimezone(tz).date()
+
+def day_matches_date(day, lesson_date):
+    """
+    Checks that an Arabic day name from the timetable falls on the given date.
+    Unknown day names are accepted as-is.
+    """
+    en_day = DAYS_MAP.get(day)
+    return en_day is None or en_day == lesson_date.strftime('%A')
+
+def day_for_date(days, lesson_date):
+    """
+    Picks the Arabic day name from days (as spelled in the school's timetable) that
+    falls on the given date, or None when the school has no lessons that day.
+    """
+    en_day = lesson_date.strftime('%A')
+    return next((day for day in days if DAYS_MAP.get(day) == en_day), None)
+
+def next_date_for_day(day, start):
+    """
+    Returns the first date on or after start that falls on the given Arabic day name,
+    or start itself when the day name is unknown.
+    """
+    en_day = DAYS_MAP.get(day)
+    if en_day is None:
+        return start
+    for offset in range(7):
+        candidate = start + timedelta(days=offset)
+        if candidate.strftime('%A') == en_day:
+            return candidate
+    return start
+
+def date_range(filter_type, date_str, today):
+    """
+    Turns a report filter ('day' with YYYY-MM-DD or 'month' with YYYY-MM) into a
+    half-open [start, end) range of lesson dates. Falls back to today on bad input.
+    """
+    try:
+        if date_str and filter_type == 'month':
+            year, month = map(int, date_str.split('-')[:2])
+            start = date(year, month, 1)
+        elif date_str:
+            start = datetime.strptime(date_str, '%Y-%m-%d').date()
+        else:
+            start = today.replace(day=1) if filter_type == 'month' else today
+    except ValueError:
+        start = today.replace(day=1) if filter_type == 'month' else today
+
+    if filter_type == 'month':
+        start = start.replace(day=1)
+        end = (start + timedelta(days=32)).replace(day=1)
+    else:
+        end = start + timedelta(days=1)
+    return start, end
+
 def parse_timetable(file_path, user_id):
     """
     Parses the Excel file and populates the database for a specific user.